@@ -1,30 +1,97 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
 import sys
 
+import orjson
+
+CONSOLE_HANDLER_NAME = "app-console"
+
+# Set LOG_FORMAT=json to emit one JSON object per line instead of plain text
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+
+
+class JsonFormatter(logging.Formatter):
+    """Render each record as a single JSON line."""
+
+    def format(self, record):
+        return orjson.dumps({
+            "ts": record.created,
+            "name": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+        }).decode()
+
+
+class BufferedStreamHandler(logging.StreamHandler):
+    """StreamHandler that leaves flushing to the caller so records are written in batches."""
+
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+        except Exception:
+            self.handleError(record)
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """Flush the handlers only once the queue runs dry, so bursts go out in one write."""
+
+    def dequeue(self, block):
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+        return self.queue.get(block)
+
+
+def _stop_listener(listener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.flush()
+
+
 def setup_logging():
     # Configure root logger
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.DEBUG)
-    
+
+    # Setup can run more than once per process (e.g. with --reload); never stack handlers
+    if any(handler.get_name() == CONSOLE_HANDLER_NAME for handler in root_logger.handlers):
+        return
+
     # Create console handler with formatting
-    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler = BufferedStreamHandler(sys.stdout)
     console_handler.setLevel(logging.DEBUG)
-    
+
     # Create formatter
-    formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+    if LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+        )
     console_handler.setFormatter(formatter)
-    
+
+    # Format and write records on a background thread; the event loop only enqueues them
+    queue_handler = logging.handlers.QueueHandler(queue.SimpleQueue())
+    queue_handler.set_name(CONSOLE_HANDLER_NAME)
+    listener = BatchingQueueListener(queue_handler.queue, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(_stop_listener, listener)
+
     # Add handler to root logger
-    root_logger.addHandler(console_handler)
-    
-    # Configure uvicorn logger
+    root_logger.addHandler(queue_handler)
+
+    # Configure uvicorn logger; keep its records from also reaching the root handler.
+    # Under uvicorn its log config has already given it a stream handler, and a
+    # second one would write every line twice.
     uvicorn_logger = logging.getLogger('uvicorn')
     uvicorn_logger.setLevel(logging.DEBUG)
-    uvicorn_logger.addHandler(console_handler)
-    
-    # Configure uvicorn.error logger
+    if not any(isinstance(handler, logging.StreamHandler) for handler in uvicorn_logger.handlers):
+        uvicorn_logger.addHandler(queue_handler)
+    uvicorn_logger.propagate = False
+
+    # Configure uvicorn.error logger; it propagates to the uvicorn handler above
     uvicorn_error_logger = logging.getLogger('uvicorn.error')
     uvicorn_error_logger.setLevel(logging.DEBUG)
-    uvicorn_error_logger.addHandler(console_handler) 
\ No newline at end of file
@@ -1,39 +1,221 @@
 from dotenv import load_dotenv
-from fastapi.logger import logger
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
-from fastapi.responses import JSONResponse
-from app.services.conversion_service import AudioConversionService
-from app.services.environment_hdri_conversion import EnvironmentHdriConversionService
-# from models.conversion_request import ConversionRequest
+from fastapi import FastAPI, HTTPException, Form
+from fastapi.responses import ORJSONResponse
+from app.services.conversion_service import AudioConversionService, mp3_bitrate
+from app.services.environment_hdri_conversion import EnvironmentHdriConversionService, get_temp_dir, shutdown_exr_pool
+from app.streaming_form import parse_streaming_form, FormParseError, UploadTooLargeError, UploadStorageError
 import os
+import posixpath
 import logging
-from supabase import create_client, Client
-from pathlib import Path
+import httpx
+import aiofiles
+from typing import AsyncIterator
+from urllib.parse import quote
 from app.logging_config import setup_logging
 import asyncio
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.requests import Request
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, suppress
 
+# Environment variables are needed at import time for the module-level settings below
 load_dotenv()
 
-# Setup logging
-setup_logging()
 logger = logging.getLogger(__name__)
 
 url: str = os.environ.get("SUPABASE_URL")
 key: str = os.environ.get("SUPABASE_SERVICE_KEY")
-supabase: Client = create_client(url, key)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB chunks
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB chunks
 
-# Create FastAPI app with unlimited file size
-app = FastAPI()
+# All objects live in one bucket, so build its URL prefixes once
+BUCKET = "realease-experience-content"
+OBJECT_PATH_PREFIX = f"/object/{BUCKET}/"
+PUBLIC_URL_PREFIX = f"{url}/storage/v1/object/public/{BUCKET}/"
 
-# Add middleware to handle large files
+# Bound concurrent transfers so a burst of requests cannot saturate the uplink.
+# A conversion downloads and uploads at the same time, so each direction gets its
+# own limit; sharing one would let waiting uploads starve the downloads they need.
+STORAGE_CONCURRENCY = 32
+download_semaphore = asyncio.Semaphore(STORAGE_CONCURRENCY)
+upload_semaphore = asyncio.Semaphore(STORAGE_CONCURRENCY)
+
+# The default executor runs the aiofiles reads that feed HDRI uploads, the cleanup
+# worker's file removals and the DNS lookups for storage connections. Give it a
+# thread per concurrent upload so their reads never queue behind one another;
+# the small default pool would make uploads wait on each other.
+DEFAULT_EXECUTOR_WORKERS = STORAGE_CONCURRENCY
+
+# Fail fast when storage is unreachable, but give multi-hundred-MB transfers time to finish
+STORAGE_TIMEOUT = httpx.Timeout(600.0, connect=20.0, pool=20.0)
+
+# Largest accepted inputs; bigger requests are refused before any of the body is read
+MAX_AUDIO_BYTES = int(os.environ.get("MAX_AUDIO_BYTES", 1024 * 1024 * 1024))  # 1GB
+MAX_HDRI_BYTES = int(os.environ.get("MAX_HDRI_BYTES", 1024 * 1024 * 1024))  # 1GB
+
+# Created once per worker in the app lifespan
+storage_client: httpx.AsyncClient | None = None
+
+
+class DownloadTooLargeError(ValueError):
+    """Raised when an object downloaded for conversion exceeds MAX_AUDIO_BYTES."""
+
+
+def create_storage_client() -> httpx.AsyncClient:
+    # Talk to the Supabase Storage REST API directly so transfers run on the event loop
+    # and share pooled HTTP/2 connections instead of tying up executor threads.
+    return httpx.AsyncClient(
+        base_url=f"{url}/storage/v1",
+        headers={"Authorization": f"Bearer {key}", "apikey": key},
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=64),
+        timeout=STORAGE_TIMEOUT,
+    )
+
+
+async def stream_from_storage(path: str) -> AsyncIterator[bytes]:
+    """Yield an object from storage chunk by chunk as it arrives."""
+    async with download_semaphore:
+        async with storage_client.stream("GET", OBJECT_PATH_PREFIX + path) as response:
+            response.raise_for_status()
+            content_length = response.headers.get("content-length")
+            if content_length and int(content_length) > MAX_AUDIO_BYTES:
+                raise DownloadTooLargeError(f"Input file is too large: {content_length} bytes (limit {MAX_AUDIO_BYTES})")
+            received = 0
+            async for chunk in response.aiter_bytes(DOWNLOAD_CHUNK_SIZE):
+                # Content-Length is not always sent, so also count what arrives
+                received += len(chunk)
+                if received > MAX_AUDIO_BYTES:
+                    raise DownloadTooLargeError(f"Input file is too large (limit {MAX_AUDIO_BYTES} bytes)")
+                yield chunk
+
+
+async def upload_to_storage(
+    path: str,
+    content: bytes | AsyncIterator[bytes],
+    content_type: str,
+    content_length: int | None = None,
+) -> None:
+    headers = {
+        "content-type": content_type,
+        "cache-control": "max-age=3600",
+        "x-upsert": "true",
+    }
+    if content_length is not None:
+        headers["content-length"] = str(content_length)
+    async with upload_semaphore:
+        response = await storage_client.post(
+            OBJECT_PATH_PREFIX + path,
+            content=content,
+            headers=headers,
+        )
+    response.raise_for_status()
+
+
+async def iter_file(file_path: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Yield a file in chunks so uploads never hold the whole file in memory."""
+    async with aiofiles.open(file_path, "rb") as f:
+        while chunk := await f.read(chunk_size):
+            yield chunk
+
+
+def with_mp3_suffix(path: str) -> str:
+    """Return path with its extension swapped for .mp3 unless it already ends in .mp3."""
+    if path[-4:].lower() == ".mp3":
+        return path
+    return posixpath.splitext(path)[0] + ".mp3"
+
+
+def get_public_url(path: str) -> str:
+    return PUBLIC_URL_PREFIX + quote(path, safe="/")
+
+
+# Temporary files waiting to be removed; one background task works through them.
+# Created once per worker in the app lifespan
+cleanup_queue: asyncio.Queue[tuple[str | None, str | None]] | None = None
+
+
+def remove_temp_files(batch: list[tuple[str | None, str | None]]) -> None:
+    for input_file, output_dir in batch:
+        try:
+            if input_file:
+                logger.debug("Cleaning up input file: %s", input_file)
+                with suppress(FileNotFoundError):
+                    os.remove(input_file)
+
+            if output_dir:
+                logger.debug("Cleaning up output directory: %s", output_dir)
+                with suppress(FileNotFoundError):
+                    shutil.rmtree(output_dir)
+
+        except Exception as e:
+            logger.error("Error during cleanup: %s", e)
+
+
+async def cleanup_worker() -> None:
+    """Remove queued temporary files, taking everything queued so far in one executor call."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await cleanup_queue.get()]
+        while not cleanup_queue.empty():
+            batch.append(cleanup_queue.get_nowait())
+        try:
+            await loop.run_in_executor(None, remove_temp_files, batch)
+        finally:
+            for _ in batch:
+                cleanup_queue.task_done()
+
+
+def schedule_cleanup(input_file: str | None, output_dir: str | None) -> None:
+    """Remove temporary files without making the caller wait for it."""
+    cleanup_queue.put_nowait((input_file, output_dir))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Run one-time setup when a worker starts and release resources when it stops."""
+    global storage_client, cleanup_queue
+    setup_logging()
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=DEFAULT_EXECUTOR_WORKERS)
+    )
+    storage_client = create_storage_client()
+    cleanup_queue = asyncio.Queue()
+    cleanup_task = asyncio.create_task(cleanup_worker())
+    try:
+        yield
+    finally:
+        # Let pending cleanups finish before the worker exits
+        await cleanup_queue.join()
+        cleanup_task.cancel()
+        await storage_client.aclose()
+        shutdown_exr_pool()
+
+
+# Create FastAPI app; responses are serialized with orjson
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# Request bodies that may carry a file, and the largest size accepted for each
+BODY_SIZE_LIMITS = {
+    "/convert_environment_hdri": MAX_HDRI_BYTES,
+}
+
+
+# Add middleware to refuse oversized uploads up front
 class LargeFileMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        if request.url.path in ["/convert_environment_hdri", "/convert"]:
-            # Remove any content length limits for these endpoints
-            request._body_size_limit = None
+        limit = BODY_SIZE_LIMITS.get(request.url.path)
+        content_length = request.headers.get("content-length")
+        if limit is not None and content_length and content_length.isdigit() and int(content_length) > limit:
+            logger.error("Rejected %s request of %s bytes", request.url.path, content_length)
+            return ORJSONResponse(
+                status_code=413,
+                content={
+                    "status": "error",
+                    "message": f"Request body too large. Maximum size is {limit} bytes"
+                }
+            )
         return await call_next(request)
 
 app.add_middleware(LargeFileMiddleware)
@@ -44,93 +226,44 @@ async def convert_audio(
     result_supabase_storage_path: str = Form(...),
     audio_quality: str = Form(default='8'),
 ):
-    logger.debug(f"Received conversion request for path: {convert_supabase_storage_path}")
-    logger.debug(f"Target path: {result_supabase_storage_path}")
+    logger.debug("Received conversion request for path: %s", convert_supabase_storage_path)
+    logger.debug("Target path: %s", result_supabase_storage_path)
     
     if not convert_supabase_storage_path:
         logger.error("No convert_supabase_storage_path provided")
         raise HTTPException(status_code=400, detail="No convert_supabase_storage_path provided")
 
-    temp_input_path = None
-    converted_path = None
-    loop = asyncio.get_event_loop()
-
+    # Reject a bad quality level before anything is downloaded
     try:
-        # Fetch file from supabase
-        logger.debug("Downloading file from Supabase")
-        file_content = await loop.run_in_executor(
-            None,
-            lambda: supabase.storage.from_("realease-experience-content").download(convert_supabase_storage_path)
+        mp3_bitrate(audio_quality)
+    except ValueError as e:
+        logger.error("Invalid audio_quality: %s", audio_quality)
+        return ORJSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
         )
-        
-        if not file_content:
-            logger.error(f"File not found in supabase: {convert_supabase_storage_path}")
-            raise HTTPException(status_code=400, detail=f"File not found in supabase: {convert_supabase_storage_path}")
-
-        # Create a temporary file for the downloaded content
-        temp_input_path = f"/tmp/{Path(convert_supabase_storage_path).name}"
-        logger.debug(f"Saving downloaded file to: {temp_input_path}")
-        
-        # Write file in binary mode asynchronously
-        async with asyncio.Lock():  # Ensure thread-safe file operations
-            with open(temp_input_path, "wb") as f:
-                f.write(file_content)
-                f.flush()
-                os.fsync(f.fileno())
-        
-        # Verify file was written
-        if not os.path.exists(temp_input_path):
-            raise HTTPException(status_code=500, detail="Failed to save temporary file")
-        
-        file_size = os.path.getsize(temp_input_path)
-        logger.debug(f"Downloaded file size: {file_size} bytes")
-        
-        if file_size == 0:
-            raise HTTPException(status_code=400, detail="Downloaded file is empty")
 
-        # Create an UploadFile object for the conversion service
-        file = UploadFile(
-            file=open(temp_input_path, "rb"),
-            filename=Path(convert_supabase_storage_path).name
-        )
+    try:
+        # Ensure the result path has .mp3 extension
+        path = with_mp3_suffix(result_supabase_storage_path)
+        logger.debug("Uploading to path: %s", path)
 
+        # Stream the file from supabase through ffmpeg and upload the MP3 while it is encoded
         logger.debug("Starting audio conversion")
-        converted_path, loudness_data = await AudioConversionService.convert_audio(
-            input_file=file,
+        output_size, loudness_data = await AudioConversionService.convert_audio(
+            input_chunks=stream_from_storage(convert_supabase_storage_path),
+            filename=posixpath.basename(convert_supabase_storage_path),
+            upload_output=lambda chunks: upload_to_storage(path, chunks, "audio/mpeg"),
             target_format='mp3',
             audio_quality=audio_quality,
         )
-        logger.debug(f"Audio conversion completed. Output path: {converted_path}")
+        logger.debug("Audio conversion completed. Output size: %d bytes", output_size)
         
-        # Upload file to supabase
-        logger.debug("Starting Supabase upload")
-        async with asyncio.Lock():  # Ensure thread-safe file operations
-            with open(converted_path, 'rb') as f:
-                bucket = "realease-experience-content"
-                # Ensure the result path has .mp3 extension
-                path = result_supabase_storage_path
-                if not path.lower().endswith('.mp3'):
-                    path = str(Path(path).with_suffix('.mp3'))
-                logger.debug(f"Uploading to path: {path}")
-                
-                response = await loop.run_in_executor(
-                    None,
-                    lambda: supabase.storage.from_(bucket).upload(
-                        path=path,
-                        file=f,
-                        file_options={
-                            "cacheControl": "3600",
-                            "upsert": "true",
-                            "contentType": "audio/mpeg"
-                        }
-                    )
-                )
-                
-                public_url = await loop.run_in_executor(
-                    None,
-                    lambda: supabase.storage.from_(bucket).get_public_url(path)
-                )
-                logger.debug(f"Upload completed. Public URL: {public_url}")
+        public_url = get_public_url(path)
+        logger.debug("Upload completed. Public URL: %s", public_url)
 
         # Extract key loudness metrics - keep as numeric values
         audio_metrics = {
@@ -148,10 +281,10 @@ async def convert_audio(
             "threshold": f"{audio_metrics['threshold']} LUFS" if audio_metrics['threshold'] != "N/A" else "N/A"
         }
         
-        logger.debug(f"Audio metrics: {audio_metrics}")
-        logger.debug(f"Formatted metrics: {audio_metrics_formatted}")
+        logger.debug("Audio metrics: %s", audio_metrics)
+        logger.debug("Formatted metrics: %s", audio_metrics_formatted)
 
-        return JSONResponse(
+        return ORJSONResponse(
             status_code=200,
             content={
                 "status": "success",
@@ -159,7 +292,7 @@ async def convert_audio(
                 "data": {
                     "public_url": public_url,
                     "path": path,
-                    "bucket": bucket,
+                    "bucket": BUCKET,
                     "content_type": "audio/mpeg",
                     "audio_metrics": audio_metrics,  # Numeric values
                     "audio_metrics_formatted": audio_metrics_formatted  # Values with units
@@ -167,9 +300,18 @@ async def convert_audio(
             }
         )
 
+    except DownloadTooLargeError as e:
+        logger.error("Input file too large: %s", e)
+        return ORJSONResponse(
+            status_code=413,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
     except Exception as e:
-        logger.error(f"Error during conversion process: {str(e)}", exc_info=True)
-        return JSONResponse(
+        logger.error("Error during conversion process: %s", e, exc_info=True)
+        return ORJSONResponse(
             status_code=500,
             content={
                 "status": "error",
@@ -180,42 +322,101 @@ async def convert_audio(
                 }
             }
         )
-    finally:
-        # Cleanup using async operations
-        try:
-            if temp_input_path and os.path.exists(temp_input_path):
-                logger.debug(f"Cleaning up temporary input file: {temp_input_path}")
-                await loop.run_in_executor(None, os.remove, temp_input_path)
-            if converted_path and os.path.exists(converted_path):
-                logger.debug(f"Cleaning up converted file: {converted_path}")
-                await loop.run_in_executor(None, os.remove, converted_path)
-        except Exception as e:
-            logger.error(f"Error during cleanup: {e}")
 
 
 
-@app.post("/convert_environment_hdri")
-async def convert_environment_hdri(
-    file: UploadFile = File(...),
-    result_supabase_storage_path: str = Form(...),
-):
+# The body is parsed by hand so the upload streams to disk; describe the form for the docs
+HDRI_FORM_SCHEMA = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "multipart/form-data": {
+                "schema": {
+                    "type": "object",
+                    "required": ["file", "result_supabase_storage_path"],
+                    "properties": {
+                        "file": {"type": "string", "format": "binary"},
+                        "result_supabase_storage_path": {"type": "string"},
+                    },
+                },
+            },
+        },
+    },
+}
+
+
+@app.post("/convert_environment_hdri", openapi_extra=HDRI_FORM_SCHEMA)
+async def convert_environment_hdri(request: Request):
     """
     Convert an environment HDRI file (EXR format) and upload to Supabase.
     
-    Args:
+    The multipart body is streamed straight into the temp directory as it
+    arrives instead of being spooled by Starlette first.
+    
+    Form fields:
         file: The EXR file to convert
         result_supabase_storage_path: The path in Supabase storage where the result will be stored
         
     Returns:
         JSON response with the public URL of the converted file
     """
-    logger.debug(f"Received environment HDRI conversion request for file: {file.filename}")
+    try:
+        # Chunked uploads carry no Content-Length, so the parser enforces the limit too
+        fields, files = await parse_streaming_form(request, get_temp_dir(), max_file_size=MAX_HDRI_BYTES)
+    except UploadTooLargeError as e:
+        logger.error("Upload too large: %s", e)
+        return ORJSONResponse(
+            status_code=413,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+    except UploadStorageError as e:
+        logger.error("Could not store upload: %s", e)
+        return ORJSONResponse(
+            status_code=507,
+            content={
+                "status": "error",
+                "message": str(e)
+            }
+        )
+    except FormParseError as e:
+        logger.error("Invalid form data: %s", e)
+        return ORJSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": f"Invalid form data: {e}"
+            }
+        )
+
+    file = files.pop("file", None)
+    result_supabase_storage_path = fields.get("result_supabase_storage_path")
+    # Only the "file" field is used; drop anything else that was uploaded
+    for extra_file in files.values():
+        schedule_cleanup(extra_file.path, None)
+    if file is None or not result_supabase_storage_path:
+        logger.error("Missing file or result_supabase_storage_path")
+        if file is not None:
+            schedule_cleanup(file.path, None)
+        return ORJSONResponse(
+            status_code=400,
+            content={
+                "status": "error",
+                "message": "Both file and result_supabase_storage_path are required"
+            }
+        )
+
+    logger.debug("Received environment HDRI conversion request for file: %s", file.filename)
     
     # Validate file extension
-    file_ext = Path(file.filename).suffix.lower()
+    dot = file.filename.rfind('.')
+    file_ext = file.filename[dot:].lower() if dot >= 0 else ''
     if file_ext not in EnvironmentHdriConversionService.SUPPORTED_FORMATS:
-        logger.error(f"Unsupported file format: {file_ext}")
-        return JSONResponse(
+        logger.error("Unsupported file format: %s", file_ext)
+        schedule_cleanup(file.path, None)
+        return ORJSONResponse(
             status_code=400,
             content={
                 "status": "error",
@@ -224,7 +425,6 @@ async def convert_environment_hdri(
         )
     
     temp_files = None
-    loop = asyncio.get_event_loop()
 
     try:
         # Convert the HDRI file
@@ -235,7 +435,7 @@ async def convert_environment_hdri(
         
         if not converted_files:
             logger.error("HDRI conversion failed: No output files generated")
-            return JSONResponse(
+            return ORJSONResponse(
                 status_code=500,
                 content={
                     "status": "error",
@@ -243,49 +443,36 @@ async def convert_environment_hdri(
                 }
             )
             
-        logger.debug(f"HDRI conversion completed. Output files: {converted_files}")
+        logger.debug("HDRI conversion completed. Output files: %s", converted_files)
         temp_files = metadata.get('temp_files', {})
         
         # Upload files to Supabase
         uploaded_files = []
         
-        for converted_path in converted_files:
+        for converted_path, result in zip(converted_files, metadata["compression_results"]):
             file_name = os.path.basename(converted_path)
             file_path = f"{result_supabase_storage_path}"
             
-            logger.debug(f"Uploading to path: {file_path}")
+            logger.debug("Uploading to path: %s", file_path)
+            
+            await upload_to_storage(
+                file_path,
+                iter_file(converted_path),
+                "image/x-exr",
+                content_length=result["compressed_size"],
+            )
+            
+            public_url = get_public_url(file_path)
+            
+            uploaded_files.append({
+                "filename": file_name,
+                "path": file_path,
+                "public_url": public_url
+            })
             
-            async with asyncio.Lock():  # Ensure thread-safe file operations
-                with open(converted_path, 'rb') as f:
-                    bucket = "realease-experience-content"
-                    
-                    response = await loop.run_in_executor(
-                        None,
-                        lambda: supabase.storage.from_(bucket).upload(
-                            path=file_path,
-                            file=f,
-                            file_options={
-                                "cacheControl": "3600",
-                                "upsert": "true",
-                                "contentType": "image/x-exr"
-                            }
-                        )
-                    )
-                    
-                    public_url = await loop.run_in_executor(
-                        None,
-                        lambda: supabase.storage.from_(bucket).get_public_url(file_path)
-                    )
-                    
-                    uploaded_files.append({
-                        "filename": file_name,
-                        "path": file_path,
-                        "public_url": public_url
-                    })
-                    
-                    logger.debug(f"Upload completed. Public URL: {public_url}")
-
-        return JSONResponse(
+            logger.debug("Upload completed. Public URL: %s", public_url)
+
+        return ORJSONResponse(
             status_code=200,
             content={
                 "status": "success",
@@ -298,8 +485,8 @@ async def convert_environment_hdri(
         )
 
     except Exception as e:
-        logger.error(f"Error during HDRI conversion process: {str(e)}", exc_info=True)
-        return JSONResponse(
+        logger.error("Error during HDRI conversion process: %s", e, exc_info=True)
+        return ORJSONResponse(
             status_code=500,
             content={
                 "status": "error",
@@ -311,19 +498,6 @@ async def convert_environment_hdri(
             }
         )
     finally:
-        # Clean up temporary files after successful upload
+        # Clean up temporary files in the background so the response is not held up
         if temp_files:
-            try:
-                input_file = temp_files.get('input_file')
-                output_dir = temp_files.get('output_dir')
-                
-                if input_file and os.path.exists(input_file):
-                    logger.debug(f"Cleaning up input file: {input_file}")
-                    await loop.run_in_executor(None, os.remove, input_file)
-                    
-                if output_dir and os.path.exists(output_dir):
-                    logger.debug(f"Cleaning up output directory: {output_dir}")
-                    await loop.run_in_executor(None, lambda: shutil.rmtree(output_dir))
-                    
-            except Exception as e:
-                logger.error(f"Error during cleanup: {e}")
\ No newline at end of file
+            schedule_cleanup(temp_files.get('input_file'), temp_files.get('output_dir'))
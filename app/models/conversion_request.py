@@ -1,5 +0,0 @@
-# from pydantic import BaseModel
-
-# class ConversionRequest(BaseModel):
-#     target_format: str = 'mp3'
-#     bitrate: str = '192k'
\ No newline at end of file
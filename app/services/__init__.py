@@ -0,0 +1,5 @@
+import os
+
+# Number of uvicorn worker processes. Each one sizes its own conversion limits
+# and worker pools, so the services split the CPU cores between them.
+WEB_CONCURRENCY = max(1, int(os.environ.get("WEB_CONCURRENCY", "1")))
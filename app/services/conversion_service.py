@@ -1,16 +1,121 @@
 import os
-import uuid
-import shutil
 import subprocess
 import logging
 import asyncio
-import json
 import re
-from fastapi import UploadFile
-from pathlib import Path
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable
+from app.services import WEB_CONCURRENCY
 
 logger = logging.getLogger(__name__)
 
+# Number of downloaded chunks that may be buffered ahead of ffmpeg
+PIPELINE_QUEUE_SIZE = 8
+
+# Size of the encoded chunks handed to the upload
+OUTPUT_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# ffmpeg's stderr can grow with the input length (e.g. repeated decoder
+# warnings); keep only the tail, which holds the loudness summary and any final error
+STDERR_TAIL_SIZE = 64 * 1024  # 64KB
+
+# Threads each ffmpeg process may use for decoding and filtering. Conversions
+# already run side by side, so ffmpeg's own default of one thread per core for
+# every process would oversubscribe the CPU; FFMPEG_THREADS overrides it.
+FFMPEG_THREADS = min(64, max(1, int(os.environ.get("FFMPEG_THREADS", "1"))))
+
+# Conversions that may run at once in this worker; extra requests wait instead of
+# making every encoder fight for the same cores. A slot is held for the whole
+# pipeline, including time spent on the storage transfers, so the default is the
+# worker's share of the cores but never fewer than MIN_ENCODE_CONCURRENCY slots.
+# ENCODE_CONCURRENCY overrides it.
+MIN_ENCODE_CONCURRENCY = 4
+ENCODE_CONCURRENCY = max(1, int(os.environ.get(
+    "ENCODE_CONCURRENCY",
+    max(MIN_ENCODE_CONCURRENCY, (os.cpu_count() or 1) // (FFMPEG_THREADS * WEB_CONCURRENCY)),
+)))
+encode_semaphore = asyncio.Semaphore(ENCODE_CONCURRENCY)
+
+# audio_quality keeps its LAME VBR meaning (0 best - 9 smallest, fractions
+# allowed as with -q:a) but is encoded as CBR at the bitrate closest to that
+# level's average. ffmpeg cannot seek back on pipe:1 to write the Xing header a
+# VBR file needs for duration and seeking.
+MP3_BITRATES = {
+    0: '256k',
+    1: '224k',
+    2: '192k',
+    3: '160k',
+    4: '160k',
+    5: '128k',
+    6: '112k',
+    7: '96k',
+    8: '80k',
+    9: '64k',
+}
+
+
+def mp3_bitrate(audio_quality: str) -> str:
+    """Return the CBR bitrate for a LAME VBR quality level, rounded to the nearest whole level."""
+    try:
+        level = float(audio_quality)
+    except ValueError:
+        level = None
+    if level is None or not 0 <= level <= 9:
+        raise ValueError(f"Unsupported audio quality: {audio_quality}. Supported values are 0 (best) to 9 (smallest)")
+    return MP3_BITRATES[round(level)]
+
+
+# Values read from the summary ebur128 logs once the input ends. Per-frame
+# values use the same labels, so matching starts at the "Summary:" line even
+# though they are only logged at verbose level; the first Threshold there is
+# the integrated one.
+LOUDNESS_SUMMARY_MARKER = 'Summary:'
+LOUDNESS_PATTERNS = {
+    "integrated_loudness": re.compile(r'I:\s*([-\d.]+)\s*LUFS'),
+    "true_peak": re.compile(r'Peak:\s*([-\d.]+)\s*dBFS'),
+    "loudness_range": re.compile(r'LRA:\s*([-\d.]+)\s*LU'),
+    "threshold": re.compile(r'Threshold:\s*([-\d.]+)\s*LUFS'),
+}
+
+
+async def _produce_chunks(input_chunks: AsyncIterator[bytes], queue: asyncio.Queue):
+    """Move input chunks onto the queue so the download keeps running while ffmpeg works."""
+    async with aclosing(input_chunks):
+        async for chunk in input_chunks:
+            await queue.put(chunk)
+    await queue.put(None)
+
+
+def _is_mp3_header(data: bytes) -> bool:
+    """Check for an ID3v2 tag or an MPEG audio frame sync at the start of the output."""
+    return data[:3] == b'ID3' or (len(data) >= 2 and data[0] == 0xFF and data[1] & 0xE0 == 0xE0)
+
+
+async def _drain_stderr(reader: asyncio.StreamReader) -> bytes:
+    """Read stderr until EOF as it is written and return its last STDERR_TAIL_SIZE bytes."""
+    tail = bytearray()
+    while chunk := await reader.read(STDERR_TAIL_SIZE):
+        tail += chunk
+        if len(tail) > 2 * STDERR_TAIL_SIZE:
+            del tail[:-STDERR_TAIL_SIZE]
+    return bytes(tail[-STDERR_TAIL_SIZE:])
+
+
+async def _feed_process(queue: asyncio.Queue, writer) -> int:
+    """Write queued chunks to ffmpeg's stdin and return the number of bytes fed."""
+    input_size = 0
+    try:
+        while (chunk := await queue.get()) is not None:
+            input_size += len(chunk)
+            writer.write(chunk)
+            await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # ffmpeg exited early; its exit code and stderr explain why
+        return input_size
+    writer.close()
+    return input_size
+
+
 class AudioConversionService:
     # List of common audio formats that FFmpeg can handle
     SUPPORTED_FORMATS = {
@@ -20,69 +125,128 @@ class AudioConversionService:
 
     @staticmethod
     async def convert_audio(
-        input_file: UploadFile, 
+        input_chunks: AsyncIterator[bytes],
+        filename: str,
+        upload_output: Callable[[AsyncIterator[bytes]], Awaitable[None]],
         target_format: str = 'mp3', 
         samplerate: str = '44100',
         audio_quality: str = '8'
     ):
-        logger.debug(f"Starting audio conversion for file: {input_file.filename}")
+        """
+        Convert streamed audio to MP3 and measure its loudness.
+        
+        A single ffmpeg process decodes the input once and splits it between
+        the ebur128 loudness meter and the MP3 encoder. The input chunks are
+        fed to it while they are still being downloaded, and upload_output is called with
+        the encoded chunks as ffmpeg produces them. The chunk iterator raises
+        instead of finishing if the conversion fails, so a partial MP3 is never
+        uploaded as if it were complete.
+        
+        Returns:
+            Tuple of the encoded MP3 size in bytes and the loudness metrics
+        """
+        logger.debug("Starting audio conversion for file: %s", filename)
         
         # Verify input file format
-        file_ext = Path(input_file.filename).suffix.lower()
+        dot = filename.rfind('.')
+        file_ext = filename[dot:].lower() if dot >= 0 else ''
         if file_ext not in AudioConversionService.SUPPORTED_FORMATS:
-            logger.error(f"Unsupported file format: {file_ext}")
+            logger.error("Unsupported file format: %s", file_ext)
             raise ValueError(f"Unsupported file format: {file_ext}. Supported formats are: {', '.join(AudioConversionService.SUPPORTED_FORMATS)}")
-        
-        # Create unique filename with UUID to avoid conflicts
-        unique_id = str(uuid.uuid4())
-        input_filename = f"/tmp/{unique_id}-{input_file.filename}"
-        output_filename = f"/tmp/{unique_id}-converted.mp3"
-        loudness_log = f"/tmp/{unique_id}-loudness.txt"
-        logger.debug(f"Input file path: {input_filename}")
-        logger.debug(f"Output file path: {output_filename}")
 
+        bitrate = mp3_bitrate(audio_quality)
+
+        # Decode once from stdin and split the audio between the MP3 encoder on
+        # stdout and the ebur128 meter on a null output; the meter's summary is
+        # logged to stderr, so keep the info log level but skip progress stats.
+        # framelog=verbose moves ebur128's line per 100ms frame below that level,
+        # leaving only the summary.
+        # libmp3lame runs in CBR mode at the bitrate mapped from audio_quality with
+        # LAME's default algorithm quality; '-compression_level 0' selects its
+        # exhaustive search, which makes CBR encodes several times slower.
+        # Decoder and filter graph threads are capped at FFMPEG_THREADS.
+        ffmpeg_command = [
+            'ffmpeg',
+            '-nostdin',
+            '-hide_banner',
+            '-nostats',
+            '-filter_complex_threads', str(FFMPEG_THREADS),
+            '-threads', str(FFMPEG_THREADS),
+            '-i', 'pipe:0',
+            '-filter_complex', '[0:a:0]asplit=2[encode][meter];[meter]ebur128=peak=true:framelog=verbose[loudness]',
+            '-map', '[encode]',
+            '-codec:a', 'libmp3lame',
+            '-b:a', bitrate,
+            '-ar', samplerate,
+            '-ac', '2',
+            '-map_metadata', '0',
+            '-id3v2_version', '3',
+            '-f', 'mp3',
+            'pipe:1',
+            '-map', '[loudness]',
+            '-f', 'null',
+            '-'
+        ]
+
+        # Connecting to storage and waiting for the first bytes is not CPU work, so
+        # only take an encode slot once the download has started delivering
         try:
-            # Save uploaded file asynchronously
-            logger.debug("Saving uploaded file")
-            async with asyncio.Lock():  # Ensure thread-safe file operations
-                with open(input_filename, "wb") as buffer:
-                    while content := await input_file.read(8192):
-                        buffer.write(content)
-            logger.debug("File saved successfully")
-
-            # Verify file exists and has size
-            if not os.path.exists(input_filename):
-                raise ValueError("Input file was not saved properly")
-            
-            file_size = os.path.getsize(input_filename)
-            logger.debug(f"Input file size: {file_size} bytes")
-            
-            if file_size == 0:
-                raise ValueError("Input file is empty")
+            first_chunk = await anext(input_chunks, None)
+            await encode_semaphore.acquire()
+        except BaseException:
+            await input_chunks.aclose()
+            raise
 
-            # Run FFmpeg to analyze loudness using ebur128 filter
-            loop = asyncio.get_event_loop()
-            logger.debug("Analyzing audio loudness with ebur128 filter")
-            
-            # First, analyze the audio with ebur128 filter
-            loudness_command = [
-                'ffmpeg',
-                '-i', input_filename,
-                '-filter_complex', 'ebur128=peak=true:meter=18',
-                '-f', 'null',
-                '-'
-            ]
-            
-            loudness_result = await loop.run_in_executor(
-                None,
-                lambda: subprocess.run(
-                    loudness_command,
-                    check=True,
-                    capture_output=True,
-                    text=True
-                )
+        process = None
+        try:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Starting FFmpeg conversion: %s", ' '.join(ffmpeg_command))
+            process = await asyncio.create_subprocess_exec(
+                *ffmpeg_command,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE
             )
-            
+
+            output_size = 0
+
+            async def output_chunks():
+                nonlocal output_size
+                while chunk := await process.stdout.read(OUTPUT_CHUNK_SIZE):
+                    # A header sniff on the first bytes replaces decoding the whole MP3 again
+                    if output_size == 0 and not _is_mp3_header(chunk):
+                        raise ValueError("Generated MP3 file is invalid or corrupted")
+                    output_size += len(chunk)
+                    yield chunk
+                # Only let the upload body end once the encode is known to be good
+                input_size = await feeder
+                if input_size == 0:
+                    raise ValueError("Input file is empty")
+                if await process.wait() != 0:
+                    stderr = (await log_task).decode(errors='replace')
+                    raise subprocess.CalledProcessError(process.returncode, ffmpeg_command, stderr=stderr)
+                if not output_size:
+                    raise ValueError("Output file is empty")
+
+            # Download, feed ffmpeg and upload the encoded output concurrently
+            queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+            if first_chunk is not None:
+                queue.put_nowait(first_chunk)
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    producer = tg.create_task(_produce_chunks(input_chunks, queue))
+                    feeder = tg.create_task(_feed_process(queue, process.stdin))
+                    # Stop downloading if ffmpeg went away early
+                    feeder.add_done_callback(lambda _: producer.cancel())
+                    log_task = tg.create_task(_drain_stderr(process.stderr))
+                    tg.create_task(upload_output(output_chunks()))
+            except ExceptionGroup as e:
+                # Surface the original failure, e.g. a download error, without the
+                # group chained onto it; that would log every traceback twice
+                raise e.exceptions[0] from None
+
+            logger.debug("Input file size: %d bytes", feeder.result())
+
             # Extract loudness information from stderr output
             loudness_data = {
                 "integrated_loudness": "N/A",
@@ -92,116 +256,35 @@ class AudioConversionService:
             }
             
             try:
-                # Parse the ebur128 output
-                output = loudness_result.stderr
-                
-                # Extract integrated loudness (I)
-                integrated_match = re.search(r'I:\s*([-\d.]+)\s*LUFS', output)
-                if integrated_match:
-                    loudness_data["integrated_loudness"] = float(integrated_match.group(1))
-                
-                # Extract true peak
-                true_peak_match = re.search(r'Peak:\s*([-\d.]+)\s*dBFS', output)
-                if true_peak_match:
-                    loudness_data["true_peak"] = float(true_peak_match.group(1))
-                
-                # Extract LRA (Loudness Range)
-                lra_match = re.search(r'LRA:\s*([-\d.]+)\s*LU', output)
-                if lra_match:
-                    loudness_data["loudness_range"] = float(lra_match.group(1))
+                # Parse the ebur128 summary
+                output = log_task.result().decode(errors='replace')
+                summary_start = output.rfind(LOUDNESS_SUMMARY_MARKER)
+                if summary_start >= 0:
+                    for name, pattern in LOUDNESS_PATTERNS.items():
+                        match = pattern.search(output, summary_start)
+                        if match:
+                            loudness_data[name] = float(match.group(1))
                 
-                # Extract threshold
-                threshold_match = re.search(r'Threshold:\s*([-\d.]+)\s*LUFS', output)
-                if threshold_match:
-                    loudness_data["threshold"] = float(threshold_match.group(1))
-                
-                logger.debug(f"Loudness analysis results: {loudness_data}")
+                logger.debug("Loudness analysis results: %s", loudness_data)
             except Exception as e:
-                logger.error(f"Error parsing loudness data: {e}")
-                logger.debug(f"Raw loudness output: {output}")
-
-            # Run FFmpeg in a thread pool to avoid blocking
-            ffmpeg_command = [
-                'ffmpeg',
-                '-y',
-                '-i', input_filename,
-                '-map', '0:a:0',
-                '-codec:a', 'libmp3lame',
-                '-q:a', audio_quality,
-                '-ar', samplerate,
-                '-ac', '2',
-                '-compression_level', '0',
-                '-map_metadata', '0',
-                '-id3v2_version', '3',
-                '-b:a', '96k',
-                '-minrate', '96k',
-                '-maxrate', '256k',
-                '-bufsize', '512k',
-                output_filename
-            ]
-            logger.debug(f"Starting FFmpeg conversion: {' '.join(ffmpeg_command)}")
-            
-            # Run FFmpeg in thread pool
-            result = await loop.run_in_executor(
-                None,
-                lambda: subprocess.run(
-                    ffmpeg_command,
-                    check=True,
-                    capture_output=True,
-                    text=True
-                )
-            )
-            
-            if result.stderr:
-                logger.debug(f"FFmpeg output: {result.stderr}")
-            
+                logger.error("Error parsing loudness data: %s", e)
+                logger.debug("Raw loudness output: %s", output)
+
             logger.debug("FFmpeg conversion completed successfully")
-            
-            # Verify output file
-            if not os.path.exists(output_filename):
-                raise ValueError("Output file was not created")
-            
-            output_size = os.path.getsize(output_filename)
-            logger.debug(f"Output file size: {output_size} bytes")
-            
-            if output_size == 0:
-                raise ValueError("Output file is empty")
-
-            # Verify MP3 in thread pool
-            verify_command = [
-                'ffmpeg',
-                '-v', 'error',
-                '-i', output_filename,
-                '-f', 'null',
-                '-'
-            ]
-            verify_result = await loop.run_in_executor(
-                None,
-                lambda: subprocess.run(
-                    verify_command,
-                    capture_output=True,
-                    text=True
-                )
-            )
-            
-            if verify_result.stderr:
-                logger.error(f"Output file verification failed: {verify_result.stderr}")
-                raise ValueError("Generated MP3 file is invalid or corrupted")
+            logger.debug("Output size: %d bytes", output_size)
 
-            return output_filename, loudness_data
+            return output_size, loudness_data
             
         except subprocess.CalledProcessError as e:
-            logger.error(f"FFmpeg conversion failed: {e.stderr}")
+            logger.error("FFmpeg conversion failed: %s", e.stderr)
             error_msg = e.stderr if e.stderr else str(e)
             raise ValueError(f"Conversion failed: {error_msg}")
         except Exception as e:
-            logger.error(f"Unexpected error during conversion: {str(e)}")
+            logger.error("Unexpected error during conversion: %s", e)
             raise
         finally:
-            # Clean up input file
-            try:
-                if os.path.exists(input_filename):
-                    logger.debug(f"Cleaning up input file: {input_filename}")
-                    await loop.run_in_executor(None, os.remove, input_filename)
-            except Exception as e:
-                logger.error(f"Error cleaning up input file: {e}")
\ No newline at end of file
+            # Never leave ffmpeg running if the pipeline failed part way
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.wait()
+            encode_semaphore.release()
@@ -1,18 +1,134 @@
 import os
 import logging
-from fastapi import UploadFile
-from pathlib import Path
+import math
 import OpenEXR
 import Imath
 import numpy as np
-from skimage.transform import resize
-import os
+import cv2
 import uuid
+import tempfile
+import atexit
+import shutil
 import asyncio
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from app.logging_config import setup_logging
+from app.services import WEB_CONCURRENCY
+from app.streaming_form import StreamedFile
 
 logger = logging.getLogger(__name__)
 
 
+def _create_temp_dir():
+    """
+    Create the directory used to stage uploads and converted files.
+    
+    Prefers the RAM-backed /dev/shm so intermediate files never hit the disk,
+    and falls back to the default temp location when it is not available.
+    """
+    shm_dir = "/dev/shm"
+    if os.path.isdir(shm_dir) and os.access(shm_dir, os.W_OK):
+        return tempfile.mkdtemp(prefix="hdri-", dir=shm_dir)
+    return tempfile.mkdtemp(prefix="hdri-")
+
+
+# Created on first use, so the spawned EXR pool processes, which import this
+# module too, do not each leave an unused directory behind
+_temp_dir: str | None = None
+
+
+def get_temp_dir() -> str:
+    """Return the staging directory, creating it and scheduling its removal on first call."""
+    global _temp_dir
+    if _temp_dir is None:
+        _temp_dir = _create_temp_dir()
+        atexit.register(shutil.rmtree, _temp_dir, ignore_errors=True)
+    return _temp_dir
+
+# Source scanlines read per step when the image shrinks by a whole-number factor;
+# keeps the float32 working set to a band instead of the whole image
+EXR_BAND_ROWS = 256
+
+# Scanlines per compressed block for PIZ (ZIP uses 16); bands are kept to multiples
+# of it so no block is decoded twice across a band edge
+EXR_BLOCK_ROWS = 32
+
+# Every uvicorn worker process has its own pool, so split the cores between them
+EXR_WORKERS = max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)
+
+# Compression is CPU-bound and holds the GIL for much of its run, so it runs in
+# worker processes instead of on the event loop. Created on first use.
+_exr_pool: ProcessPoolExecutor | None = None
+
+
+def _init_exr_worker():
+    """Set up a pool process: log like the server does and keep OpenCV single-threaded."""
+    setup_logging()
+    # Requests already run side by side in separate processes
+    cv2.setNumThreads(1)
+
+
+def _get_exr_pool() -> ProcessPoolExecutor:
+    global _exr_pool
+    if _exr_pool is None:
+        # Spawn fresh interpreters; forking the server would copy its event loop and threads
+        _exr_pool = ProcessPoolExecutor(
+            max_workers=EXR_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_exr_worker,
+        )
+    return _exr_pool
+
+
+def _discard_exr_pool(pool: ProcessPoolExecutor):
+    global _exr_pool
+    if _exr_pool is pool:
+        _exr_pool = None
+    pool.shutdown(wait=False)
+
+
+def shutdown_exr_pool():
+    """Stop the worker processes, if any were started."""
+    global _exr_pool
+    if _exr_pool is not None:
+        _exr_pool.shutdown(cancel_futures=True)
+        _exr_pool = None
+
+
+def _read_pixels(exr_file, channels, width, first_line, last_line):
+    """Read scanlines first_line to last_line of the channels as a height x width x channel float32 array."""
+    raw_channels = exr_file.channels(channels, Imath.PixelType(Imath.PixelType.FLOAT), first_line, last_line)
+    return np.stack([np.frombuffer(raw, dtype=np.float32).reshape(-1, width) for raw in raw_channels], axis=-1)
+
+
+def _resize(pixels, target_width, target_height):
+    """
+    Resize a height x width x channel image with OpenCV in 32-bit float.
+
+    When shrinking, the area filter averages every source pixel under each output
+    pixel, so the downscale is anti-aliased; smaller inputs are enlarged bilinearly.
+    If one axis shrinks while the other grows, each axis is resized on its own so
+    the shrinking one still gets the area filter.
+    """
+    height, width, channel_count = pixels.shape
+    if (target_width < width and target_height > height) or (target_width > width and target_height < height):
+        # Shrink first so the enlarging pass works on fewer pixels
+        if target_width < width:
+            pixels = _resize(pixels, target_width, height)
+        else:
+            pixels = _resize(pixels, width, target_height)
+        return _resize(pixels, target_width, target_height)
+    if width >= target_width and height >= target_height:
+        interpolation = cv2.INTER_AREA
+    else:
+        interpolation = cv2.INTER_LINEAR
+    resized = cv2.resize(pixels, (target_width, target_height), interpolation=interpolation)
+    # cv2 drops the channel axis of single-channel images, so restore it
+    return resized.reshape(target_height, target_width, channel_count)
+
+
 def compress_exr(input_path, output_dir):
     """
     Compress an .exr file: reduce bit depth to 16-bit, downscale to 2K, and apply ZIP compression.
@@ -20,6 +136,9 @@ def compress_exr(input_path, output_dir):
     Args:
         input_path (str): Path to the input .exr file.
         output_dir (str): Directory to save the compressed output files.
+
+    Returns:
+        str: Path of the compressed file.
     """
     # Ensure output directory exists
     os.makedirs(output_dir, exist_ok=True)
@@ -32,39 +151,49 @@ def compress_exr(input_path, output_dir):
     dw = header['dataWindow']
     width = dw.max.x - dw.min.x + 1
     height = dw.max.y - dw.min.y + 1
-    logger.debug(f"Input dimensions: {width}x{height}")
+    logger.debug("Input dimensions: %dx%d", width, height)
 
-    # Define channel type (FLOAT for 32-bit, HALF for 16-bit)
-    FLOAT = Imath.PixelType(Imath.PixelType.FLOAT)
+    # Output channel type (HALF for 16-bit float)
     HALF = Imath.PixelType(Imath.PixelType.HALF)
 
-    # Read RGB and Alpha channels as 32-bit float
-    channels = ['R', 'G', 'B', 'A']
-    pixel_data = {}
-    for ch in channels:
-        if ch in header['channels']:
-            data = np.frombuffer(exr_file.channel(ch, FLOAT), dtype=np.float32)
-            pixel_data[ch] = data.reshape(height, width)
+    # Resize the RGB and Alpha channels present in the file
+    channels = [ch for ch in ('R', 'G', 'B', 'A') if ch in header['channels']]
+    if not channels:
+        raise ValueError("Input file has no RGB or alpha channels")
 
     # Target 2K resolution (maintain aspect ratio)
     target_width = 2048
     target_height = 1024
-    logger.debug(f"Processing 2K resolution: {target_width}x{target_height}")
-    
-    # Resize the image using skimage.transform.resize
-    resized_data = {}
-    for ch in pixel_data:
-        # Convert to 2D array and resize
-        img = pixel_data[ch]
-        resized_img = resize(img, (target_height, target_width), mode='reflect', anti_aliasing=True, preserve_range=True)
-        resized_data[ch] = resized_img  # Keep as 32-bit float during processing, no transpose
-        logger.debug(f"Resized channel {ch} to shape: {resized_data[ch].shape}")
+    logger.debug("Processing 2K resolution: %dx%d", target_width, target_height)
+
+    # The 16-bit output, one contiguous plane per channel as writePixels takes it.
+    # Resized rows are converted to half float as they are stored, so no full-size
+    # 32-bit copy of the result is ever kept.
+    planes = np.empty((len(channels), target_height, target_width), dtype=np.float16)
+
+    factor_x, factor_y = width // target_width, height // target_height
+    if factor_x and factor_y and width == factor_x * target_width and height == factor_y * target_height:
+        # Whole-number downscales average disjoint blocks of source rows, so the
+        # image can be read and shrunk a band of rows at a time
+        band_step = math.lcm(factor_y, EXR_BLOCK_ROWS)
+        band_rows = band_step * max(1, EXR_BAND_ROWS // band_step)
+        for row in range(0, height, band_rows):
+            last_row = min(row + band_rows, height) - 1
+            pixels = _read_pixels(exr_file, channels, width, dw.min.y + row, dw.min.y + last_row)
+            resized = _resize(pixels, target_width, pixels.shape[0] // factor_y)
+            planes[:, row // factor_y:(last_row + 1) // factor_y] = np.moveaxis(resized, -1, 0)
+    else:
+        pixels = _read_pixels(exr_file, channels, width, dw.min.y, dw.max.y)
+        planes[...] = np.moveaxis(_resize(pixels, target_width, target_height), -1, 0)
+    del pixels
+    logger.debug("Resized channels %s to shape: %s", channels, planes.shape)
 
     # Update header for new resolution and compression
     new_header = header.copy()
     new_header['dataWindow'] = Imath.Box2i(Imath.V2i(0, 0), Imath.V2i(target_width - 1, target_height - 1))
     new_header['displayWindow'] = new_header['dataWindow']
-    new_header['compression'] = OpenEXR.ZIP_COMPRESSION
+    # The legacy header only accepts an Imath.Compression here; a bare constant is ignored
+    new_header['compression'] = Imath.Compression(Imath.Compression.ZIP_COMPRESSION)
     
     # Update channel formats to HALF (16-bit float)
     for ch in new_header['channels']:
@@ -73,24 +202,21 @@ def compress_exr(input_path, output_dir):
     # Define output path
     base_name = os.path.splitext(os.path.basename(input_path))[0]
     output_path = os.path.join(output_dir, f"{base_name}_2K_ZIP.exr")
-    logger.debug(f"Saving with ZIP compression to: {output_path}")
+    logger.debug("Saving with ZIP compression to: %s", output_path)
 
     try:
         # Write the new .exr file
         output_file = OpenEXR.OutputFile(output_path, new_header)
-        output_data = {}
-        for ch in resized_data:
-            # Convert to 16-bit float only at write time and ensure data is contiguous
-            data_16bit = resized_data[ch].astype(np.float16)
-            output_data[ch] = np.ascontiguousarray(data_16bit).tobytes()
-        output_file.writePixels(output_data)
+        # writePixels reads the planes through the buffer protocol without another copy
+        output_file.writePixels({ch: planes[i] for i, ch in enumerate(channels)})
         output_file.close()
-        logger.debug(f"Successfully saved: {output_path}")
+        logger.debug("Successfully saved: %s", output_path)
     except Exception as e:
-        logger.error(f"Error saving {output_path}: {str(e)}")
+        logger.error("Error saving %s: %s", output_path, e)
         raise
 
     logger.debug("Compression complete!")
+    return output_path
 
 
 class EnvironmentHdriConversionService:
@@ -101,74 +227,53 @@ class EnvironmentHdriConversionService:
 
     @staticmethod
     async def convert(
-        input_file: UploadFile, 
+        input_file: StreamedFile, 
     ):
         """
         Convert an environment HDRI file.
         
         Args:
-            input_file: The uploaded file to convert
+            input_file: The uploaded file, already streamed to disk under get_temp_dir()
             
         Returns:
             Tuple containing a list of output file paths and metadata
         """
-        logger.debug(f"Starting HDRI conversion for file: {input_file.filename}")
+        logger.debug("Starting HDRI conversion for file: %s", input_file.filename)
         
-        # Create unique filename with UUID to avoid conflicts
-        unique_id = str(uuid.uuid4())
-        input_filename = f"/tmp/{unique_id}-{input_file.filename}"
-        output_dir = f"/tmp/{unique_id}-output"
+        input_filename = input_file.path
+        file_size = input_file.size
+        # Create unique output directory with UUID to avoid conflicts
+        output_dir = os.path.join(get_temp_dir(), f"{uuid.uuid4().hex}-output")
         
         try:
-            # Save uploaded file in chunks
-            logger.debug(f"Saving uploaded file to: {input_filename}")
-            CHUNK_SIZE = 1024 * 1024  # 1MB chunks
-            
-            async with asyncio.Lock():  # Ensure thread-safe file operations
-                with open(input_filename, "wb") as buffer:
-                    while True:
-                        chunk = await input_file.read(CHUNK_SIZE)
-                        if not chunk:
-                            break
-                        buffer.write(chunk)
-                        
-            logger.debug("File saved successfully")
-            
-            # Verify file exists and has size
-            if not os.path.exists(input_filename):
-                raise ValueError("Input file was not saved properly")
-            
-            file_size = os.path.getsize(input_filename)
-            logger.debug(f"Input file size: {file_size} bytes")
+            logger.debug("Input file size: %d bytes", file_size)
             
             if file_size == 0:
                 raise ValueError("Input file is empty")
             
-            # Create output directory
-            os.makedirs(output_dir, exist_ok=True)
-            
-            # Perform the actual compression
+            # Perform the actual compression; it creates output_dir
             logger.debug("Starting EXR compression")
-            compress_exr(input_filename, output_dir)
+            pool = _get_exr_pool()
+            try:
+                output_file = await asyncio.get_running_loop().run_in_executor(pool, compress_exr, input_filename, output_dir)
+            except BrokenProcessPool:
+                # A worker died (e.g. killed for running out of memory); let the next
+                # request start a fresh pool instead of failing on this one forever
+                _discard_exr_pool(pool)
+                raise
             logger.debug("EXR compression completed")
             
-            # Get list of generated files
-            output_files = [os.path.join(output_dir, f) for f in os.listdir(output_dir) if f.endswith('.exr')]
+            output_files = [output_file]
             
-            if not output_files:
-                raise ValueError("No output files were generated during compression")
-            
-            # Get compression results
-            compression_results = []
-            for output_file in output_files:
-                output_size = os.path.getsize(output_file)
-                compression_ratio = (file_size - output_size) / file_size * 100
-                compression_results.append({
-                    "file": os.path.basename(output_file),
-                    "original_size": file_size,
-                    "compressed_size": output_size,
-                    "compression_ratio": f"{compression_ratio:.1f}%"
-                })
+            # Get compression results; a missing output raises FileNotFoundError here
+            output_size = os.stat(output_file).st_size
+            compression_ratio = (file_size - output_size) / file_size * 100
+            compression_results = [{
+                "file": os.path.basename(output_file),
+                "original_size": file_size,
+                "compressed_size": output_size,
+                "compression_ratio": f"{compression_ratio:.1f}%"
+            }]
             
             # Metadata about the conversion
             metadata = {
@@ -186,14 +291,12 @@ class EnvironmentHdriConversionService:
             return output_files, metadata
             
         except Exception as e:
-            logger.error(f"Error during HDRI conversion: {str(e)}")
+            logger.error("Error during HDRI conversion: %s", e)
             # Clean up only on error
             try:
-                if os.path.exists(input_filename):
+                with contextlib.suppress(FileNotFoundError):
                     os.remove(input_filename)
-                if os.path.exists(output_dir):
-                    import shutil
-                    shutil.rmtree(output_dir)
+                shutil.rmtree(output_dir, ignore_errors=True)
             except Exception as cleanup_error:
-                logger.error(f"Error during cleanup: {cleanup_error}")
+                logger.error("Error during cleanup: %s", cleanup_error)
             raise
\ No newline at end of file
@@ -0,0 +1,246 @@
+"""
+Parse multipart/form-data request bodies while they are being received.
+
+File parts are written straight into a directory on disk as the body
+arrives, instead of being spooled by Starlette and copied again afterwards,
+so an upload of any size is written exactly once and never held in memory.
+"""
+import os
+import uuid
+import logging
+from python_multipart.exceptions import MultipartParseError
+from python_multipart.multipart import MultipartParser, parse_options_header
+from starlette.requests import Request
+
+logger = logging.getLogger(__name__)
+
+# Plain form fields are kept in memory, so cap their size
+MAX_FIELD_SIZE = 1024 * 1024  # 1MB
+
+# The server hands the body over in small pieces; collect them into large writes
+WRITE_CHUNK_SIZE = 1024 * 1024  # 1MB
+
+# Write buffers kept around for reuse once their upload has finished
+MAX_POOLED_BUFFERS = 64
+
+# Longest parts of the client-supplied name kept in the names of files written to
+# disk; with the UUID prefix they stay well within the usual 255-byte limit
+MAX_STEM_BYTES = 128
+MAX_EXTENSION_LENGTH = 16
+
+
+class FormParseError(ValueError):
+    """Raised when the request body is not a well-formed multipart form."""
+
+
+class UploadTooLargeError(FormParseError):
+    """Raised when a file part grows past the allowed size."""
+
+
+class UploadStorageError(FormParseError):
+    """Raised when a file part cannot be written to the upload directory."""
+
+
+class _BufferPool:
+    """Hands out fixed-size bytearrays and keeps returned ones for the next upload."""
+
+    def __init__(self, buffer_size: int, max_buffers: int):
+        self.buffer_size = buffer_size
+        self.max_buffers = max_buffers
+        self._free: list[bytearray] = []
+
+    def acquire(self) -> bytearray:
+        return self._free.pop() if self._free else bytearray(self.buffer_size)
+
+    def release(self, buffer: bytearray):
+        if len(self._free) < self.max_buffers:
+            self._free.append(buffer)
+
+
+# Only touched from parser callbacks, which all run on the event loop thread
+_write_buffers = _BufferPool(WRITE_CHUNK_SIZE, MAX_POOLED_BUFFERS)
+
+
+def _stored_name(filename: str) -> str:
+    """Build a unique on-disk name that keeps a shortened, printable form of the client's name."""
+    stem, ext = os.path.splitext(filename)
+    if len(ext) > MAX_EXTENSION_LENGTH or not (ext[1:].isascii() and ext[1:].isalnum()):
+        stem, ext = filename, ""
+    stem = "".join(ch if ch.isprintable() else "_" for ch in stem)
+    # Cut on a character boundary so the name stays valid UTF-8
+    stem = stem.encode()[:MAX_STEM_BYTES].decode(errors="ignore")
+    return f"{uuid.uuid4().hex}-{stem}{ext}"
+
+
+class StreamedFile:
+    """A file part that was written to disk while the request body arrived."""
+
+    def __init__(self, filename: str, path: str):
+        self.filename = filename
+        self.path = path
+        self.size = 0
+
+
+class _StreamingFormParser:
+    """Callbacks for python-multipart that collect fields and write file parts to disk."""
+
+    def __init__(self, upload_dir: str, max_file_size: int | None):
+        self.upload_dir = upload_dir
+        self.max_file_size = max_file_size
+        self.fields: dict[str, str] = {}
+        self.files: dict[str, StreamedFile] = {}
+        self._header_name = b""
+        self._header_value = b""
+        self._disposition = b""
+        self._name = ""
+        self._data = bytearray()
+        self._file: StreamedFile | None = None
+        self._fd: int | None = None
+        self._buffer: bytearray | None = None
+        self._buffered = 0
+
+    def on_part_begin(self):
+        self._disposition = b""
+        self._data = bytearray()
+        self._file = None
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_name += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_name.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_name = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        if b"name" not in options:
+            raise FormParseError('The Content-Disposition header field "name" must be provided')
+        self._name = options[b"name"].decode(errors="replace")
+
+        if b"filename" in options:
+            if self._name in self.files:
+                raise FormParseError(f"Duplicate file field: {self._name}")
+            # Keep the client-supplied name from escaping the upload directory
+            filename = os.path.basename(options[b"filename"].decode(errors="replace"))
+            path = os.path.join(self.upload_dir, _stored_name(filename))
+            try:
+                self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            except OSError as e:
+                raise UploadStorageError(f"Could not store file {filename}: {e.strerror}") from e
+            self._buffer = _write_buffers.acquire()
+            self._file = StreamedFile(filename, path)
+            self.files[self._name] = self._file
+            logger.debug("Streaming form file %s to: %s", filename, path)
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        if self._file is None:
+            if len(self._data) + end - start > MAX_FIELD_SIZE:
+                raise FormParseError(f"Form field {self._name} is too large")
+            self._data += data[start:end]
+            return
+
+        self._file.size += end - start
+        if self.max_file_size is not None and self._file.size > self.max_file_size:
+            raise UploadTooLargeError(f"File {self._file.filename} exceeds {self.max_file_size} bytes")
+        # Copy into the pooled buffer and write it out each time it fills up
+        view = memoryview(data)[start:end]
+        while view:
+            count = min(len(view), len(self._buffer) - self._buffered)
+            self._buffer[self._buffered:self._buffered + count] = view[:count]
+            self._buffered += count
+            view = view[count:]
+            if self._buffered == len(self._buffer):
+                self._flush()
+
+    def on_part_end(self):
+        if self._file is None:
+            self.fields[self._name] = self._data.decode(errors="replace")
+        else:
+            self._flush()
+            self._close_file()
+
+    @property
+    def in_file_part(self) -> bool:
+        return self._fd is not None
+
+    def _flush(self):
+        view = memoryview(self._buffer)[:self._buffered]
+        try:
+            while view:
+                view = view[os.write(self._fd, view):]
+        except OSError as e:
+            # e.g. ENOSPC once /dev/shm fills up
+            raise UploadStorageError(f"Could not store file {self._file.filename}: {e.strerror}") from e
+        self._buffered = 0
+
+    def _close_file(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if self._buffer is not None:
+            _write_buffers.release(self._buffer)
+            self._buffer = None
+            self._buffered = 0
+
+    def discard(self):
+        """Close and remove every file written so far."""
+        self._close_file()
+        for streamed_file in self.files.values():
+            try:
+                os.remove(streamed_file.path)
+            except FileNotFoundError:
+                pass
+
+
+async def parse_streaming_form(
+    request: Request,
+    upload_dir: str,
+    max_file_size: int | None = None,
+) -> tuple[dict[str, str], dict[str, StreamedFile]]:
+    """
+    Read a multipart/form-data request body, writing file parts into upload_dir.
+
+    Args:
+        request: The incoming request; its body must not have been read yet
+        upload_dir: Directory the file parts are written to
+        max_file_size: Reject file parts larger than this many bytes
+
+    Returns:
+        Tuple of the plain form fields and the streamed files, both keyed by field name
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type"))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise FormParseError("Expected a multipart/form-data request body")
+
+    form = _StreamingFormParser(upload_dir, max_file_size)
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": form.on_part_begin,
+        "on_part_data": form.on_part_data,
+        "on_part_end": form.on_part_end,
+        "on_header_field": form.on_header_field,
+        "on_header_value": form.on_header_value,
+        "on_header_end": form.on_header_end,
+        "on_headers_finished": form.on_headers_finished,
+    })
+
+    try:
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+            parser.finalize()
+        except MultipartParseError as e:
+            raise FormParseError(str(e)) from e
+
+        if form.in_file_part:
+            raise FormParseError("Request body ended in the middle of a file")
+    except BaseException:
+        # Includes client disconnects and cancellation; never leave partial files behind
+        form.discard()
+        raise
+
+    return form.fields, form.files